@@ -2,10 +2,14 @@
 #
 # License: BSD (3-clause)
 
+import copy
+import math
+from typing import Optional
+
 import torch
 from torch import nn
-
-from .modules import Expression, Ensure4d
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_conv_bn_weights
 
 
 class EEGInceptionMI(nn.Module):
@@ -23,6 +27,9 @@ class EEGInceptionMI(nn.Module):
     This implementation is not guaranteed to be correct, has not been checked
     by original authors, only reimplemented bosed on the paper [1]_.
 
+    The model expects inputs of shape (batch_size, in_channels, n_times).
+    Inputs of shape (batch_size, in_channels, n_times, 1) are also accepted.
+
     Parameters
     ----------
     in_channels : int
@@ -48,6 +55,24 @@ class EEGInceptionMI(nn.Module):
         0.9 here for `n_convs`=5). Defaults to 0.1 s.
     activation: nn.Module
         Activation function. Defaults to ReLU activation.
+    add_log_softmax: bool, optional
+        Whether to apply a log softmax to the outputs. Defaults to True. When
+        False, the model returns logits, which can be fed to
+        ``torch.nn.functional.cross_entropy`` during training (fusing the log
+        softmax with the loss) and whose argmax directly gives the predicted
+        class at inference.
+    simplify_matched_residual: bool, optional
+        Whether to use an identity skip connection around the second block of
+        inception modules, whose input and output have the same number of
+        channels, instead of a 1x1 convolution followed by batch norm and
+        activation as in [1]_. This saves the computation of one residual
+        module, but changes the architecture and the number of parameters
+        from the paper. Defaults to False.
+    overlap_residual_streams: bool, optional
+        Whether to run the residual modules on a side CUDA stream, so that
+        they can overlap with the inception modules they skip, when the model
+        is on GPU. This is experimental and has not been benchmarked.
+        Defaults to False.
 
     References
     ----------
@@ -67,6 +92,9 @@ class EEGInceptionMI(nn.Module):
             n_filters=48,
             kernel_unit_s=0.1,
             activation=nn.ReLU(),
+            add_log_softmax=True,
+            simplify_matched_residual=False,
+            overlap_residual_streams=False,
     ):
         super().__init__()
 
@@ -79,18 +107,23 @@ class EEGInceptionMI(nn.Module):
         self.n_filters = n_filters
         self.kernel_unit_s = kernel_unit_s
         self.activation = activation
+        self.add_log_softmax = add_log_softmax
+        self.simplify_matched_residual = simplify_matched_residual
+        self.overlap_residual_streams = overlap_residual_streams
 
-        self.ensuredims = Ensure4d()
-        self.dimshuffle = Expression(_transpose_to_b_c_1_t)
+        # Kernel sizes of the convolutions of each inception module, odd
+        # multiples of the basic kernel size
+        kernel_unit = int(self.kernel_unit_s * self.sfreq)
+        self.kernel_sizes = [
+            (n_units * 2 + 1) * kernel_unit for n_units in range(self.n_convs)
+        ]
 
         # ======== Inception branches ========================
 
         self.initial_inception_module = _InceptionModuleMI(
             in_channels=self.in_channels,
             n_filters=self.n_filters,
-            n_convs=self.n_convs,
-            kernel_unit_s=self.kernel_unit_s,
-            sfreq=self.sfreq,
+            kernel_sizes=self.kernel_sizes,
             activation=self.activation,
         )
 
@@ -100,9 +133,7 @@ class EEGInceptionMI(nn.Module):
             _InceptionModuleMI(
                 in_channels=intermediate_in_channels,
                 n_filters=self.n_filters,
-                n_convs=self.n_convs,
-                kernel_unit_s=self.kernel_unit_s,
-                sfreq=self.sfreq,
+                kernel_sizes=self.kernel_sizes,
                 activation=self.activation,
             ) for _ in range(2)
         ])
@@ -117,18 +148,20 @@ class EEGInceptionMI(nn.Module):
             _InceptionModuleMI(
                 in_channels=intermediate_in_channels,
                 n_filters=self.n_filters,
-                n_convs=self.n_convs,
-                kernel_unit_s=self.kernel_unit_s,
-                sfreq=self.sfreq,
+                kernel_sizes=self.kernel_sizes,
                 activation=self.activation,
             ) for _ in range(3)
         ])
 
-        self.residual_block_2 = _ResidualModuleMI(
-            in_channels=intermediate_in_channels,
-            n_filters=intermediate_in_channels,
-            activation=self.activation,
-        )
+        if self.simplify_matched_residual:
+            # The main branch already ends with batch norm and activation
+            self.residual_block_2 = nn.Identity()
+        else:
+            self.residual_block_2 = _ResidualModuleMI(
+                in_channels=intermediate_in_channels,
+                n_filters=intermediate_in_channels,
+                activation=self.activation,
+            )
 
         # XXX The paper mentions a final average pooling but does not indicate
         # the kernel size... The only info available is figure1 showing a
@@ -139,12 +172,8 @@ class EEGInceptionMI(nn.Module):
         # pooling, we see a small number of parameters, potentially indicating
         # that the whole time dimension is averaged on this stage for each
         # channel. We follow this last hypothesis here to comply with the
-        # number of parameters reported in the paper.
-        self.ave_pooling = nn.AvgPool2d(
-            kernel_size=(1, self.input_window_samples),
-        )
-
-        self.flat = nn.Flatten()
+        # number of parameters reported in the paper. This average is
+        # computed in forward, directly feeding the linear layer.
         self.fc = nn.Linear(
             # in_features=self.input_window_samples * intermediate_in_channels,
             in_features=intermediate_in_channels,
@@ -152,34 +181,353 @@ class EEGInceptionMI(nn.Module):
             bias=True,
         )
 
-        self.softmax = nn.LogSoftmax(dim=1)
+        if self.add_log_softmax:
+            self.softmax = nn.LogSoftmax(dim=1)
+        else:
+            self.softmax = nn.Identity()
+
+        self._on_cuda = self.fc.weight.is_cuda
+
+        # All convolutions have kernels of shape (1, k). With the channels
+        # last memory format, oneDNN and cuDNN can use their faster NHWC
+        # kernels for these and for the concatenation of inception branches.
+        # Although convolutions are 1D in time, nn.Conv1d is not used: there
+        # is no channels last format for 3D tensors, and its (B, C, T) layout
+        # goes through the NCHW kernels, about twice slower on CPU.
+        self.to(memory_format=torch.channels_last)
 
     def forward(
         self,
         X: torch.Tensor,
     ) -> torch.Tensor:
-        X = self.ensuredims(X)
-        X = self.dimshuffle(X)
+        X = _reshape_input(X)
+        X = X.contiguous(memory_format=torch.channels_last)
+
+        if not torch.jit.is_scripting() and self._overlap_residuals():
+            return self._forward_overlapping_residuals(X)
 
         res1 = self.residual_block_1(X)
+        out = self._inception_block_1(X)
+        out = out + res1
+
+        res2 = self.residual_block_2(out)
+        out = self._inception_block_2(out)
+        out = res2 + out
 
+        return self._classify(out)
+
+    def _inception_block_1(self, X: torch.Tensor) -> torch.Tensor:
         out = self.initial_inception_module(X)
         for layer in self.intermediate_inception_modules_1:
             out = layer(out)
+        return out
 
-        out = out + res1
-
-        res2 = self.residual_block_2(out)
-
+    def _inception_block_2(self, X: torch.Tensor) -> torch.Tensor:
+        out = X
         for layer in self.intermediate_inception_modules_2:
             out = layer(out)
+        return out
+
+    def _classify(self, X: torch.Tensor) -> torch.Tensor:
+        out = self.fc(X.mean(dim=(2, 3)))
+        return self.softmax(out)
 
+    @torch.jit.unused
+    def _overlap_residuals(self) -> bool:
+        # When compiling or capturing a CUDA graph, scheduling is left to the
+        # compiler or to the graph
+        return (self.overlap_residual_streams and self._on_cuda
+                and not _is_compiling()
+                and not torch.cuda.is_current_stream_capturing())
+
+    @torch.jit.unused
+    def _forward_overlapping_residuals(self, X: torch.Tensor) -> torch.Tensor:
+        """Same as forward, running residual modules on a side CUDA stream.
+
+        Residual modules only depend on the input of the inception modules
+        they skip, so they can run concurrently with them instead of being
+        serialized on the current stream.
+        """
+        main_stream = torch.cuda.current_stream(X.device)
+        side_stream = torch.cuda.Stream(X.device)
+
+        side_stream.wait_stream(main_stream)
+        with torch.cuda.stream(side_stream):
+            res1 = self.residual_block_1(X)
+        out = self._inception_block_1(X)
+        main_stream.wait_stream(side_stream)
+        # Tensors used on both streams must not be reused by the caching
+        # allocator before the work of both streams on them is done
+        X.record_stream(side_stream)
+        res1.record_stream(main_stream)
+        out = out + res1
+
+        side_stream.wait_stream(main_stream)
+        with torch.cuda.stream(side_stream):
+            res2 = self.residual_block_2(out)
+        res2.record_stream(main_stream)
+        out.record_stream(side_stream)
+        out = self._inception_block_2(out)
+        main_stream.wait_stream(side_stream)
         out = res2 + out
 
-        out = self.ave_pooling(out)
-        out = self.flat(out)
-        out = self.fc(out)
-        return self.softmax(out)
+        return self._classify(out)
+
+    def _apply(self, *args, **kwargs):
+        module = super()._apply(*args, **kwargs)
+        self._on_cuda = self.fc.weight.is_cuda
+        return module
+
+    @classmethod
+    def compiled(cls, *args, **kwargs):
+        """Build the model and compile it with ``torch.compile``.
+
+        The model is compiled as a single graph, which lets TorchInductor fuse
+        the batch norms, activations and residual additions and removes the
+        Python overhead between the many small convolutions. In
+        ``"reduce-overhead"`` mode, CUDA graphs are used on GPU. Shapes are
+        considered static: all kernel sizes are fixed at construction and
+        inputs are expected to have ``input_window_samples`` time samples, so
+        the model is compiled once for a given batch size.
+
+        Parameters
+        ----------
+        *args, **kwargs
+            Arguments passed to the model constructor.
+
+        Returns
+        -------
+        model : torch.nn.Module
+            The compiled model, sharing its parameters with the original one.
+        """
+        model = cls(*args, **kwargs)
+        return torch.compile(
+            model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+    def to_frozen(self):
+        """Script and freeze the model for inference with TorchScript.
+
+        All kernel sizes and channel numbers are fixed at construction, so
+        freezing the scripted model inlines parameters and attributes as
+        constants, unrolls the loops over branches and removes the training
+        branches of batch norm layers. ``torch.jit.optimize_for_inference``
+        is not applied: its MKLDNN conversion makes the model about 1.8 times
+        slower on CPU.
+
+        The model itself is set to evaluation mode. The first calls of the
+        returned module are slower, as the profiling executor records shapes
+        before optimizing the graph. To avoid this warm-up, e.g. when only a
+        few predictions are needed, call it within
+        ``torch.jit.optimized_execution(False)``.
+
+        Returns
+        -------
+        model : torch.jit.ScriptModule
+            The frozen model.
+        """
+        return torch.jit.freeze(torch.jit.script(self.eval()))
+
+    def quantize(self, X_calib):
+        """Quantize the model to int8 for inference on CPU.
+
+        Static post-training quantization is applied with FX graph mode
+        quantization, using the default ``"x86"`` configuration: weights are
+        quantized per channel and activations per tensor. Batch norm layers
+        are first folded into the convolutions (see
+        :meth:`fuse_for_inference`). Residual additions and concatenations
+        are traced as graph nodes, so they are quantized without needing
+        ``FloatFunctional`` modules.
+
+        Parameters
+        ----------
+        X_calib : torch.Tensor | iterable of torch.Tensor
+            Held-out batches of EEG windows, used to calibrate the ranges of
+            activations. They are moved to CPU.
+
+        Returns
+        -------
+        model : torch.fx.GraphModule
+            The quantized model. The model itself is left unchanged.
+        """
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        if isinstance(X_calib, torch.Tensor):
+            X_calib = [X_calib]
+        X_calib = iter(X_calib)
+        X = next(X_calib, None)
+        if X is None:
+            raise ValueError("X_calib must contain at least one batch.")
+
+        # Quantized models run on CPU, whatever the device of the model
+        model = copy.deepcopy(self).cpu().eval().fuse_for_inference()
+        model = prepare_fx(
+            model, get_default_qconfig_mapping("x86"), (X.cpu(),))
+        with torch.no_grad():
+            model(X.cpu())
+            for X in X_calib:
+                model(X.cpu())
+        return convert_fx(model)
+
+    def predict(self, X):
+        """Predict with mixed precision, running convolutions in bfloat16.
+
+        The forward pass is run under ``torch.autocast`` on the device of
+        ``X``: convolutions and the final linear layer use bfloat16 tensor
+        core (GPU) or oneDNN (CPU) kernels. Batch norm layers are run in
+        float32 with autocast disabled, as autocast would otherwise run them
+        in the precision of their bfloat16 inputs. The model is set to
+        evaluation mode.
+
+        Parameters
+        ----------
+        X : torch.Tensor
+            Batch of EEG windows, on the same device as the model.
+
+        Returns
+        -------
+        out : torch.Tensor
+            The float32 outputs of the model.
+        """
+        self.eval()
+        with torch.inference_mode(), torch.autocast(
+                device_type=X.device.type, dtype=torch.bfloat16):
+            out = self(X)
+        return out.float()
+
+    def capture_graph(self, batch_size):
+        """Capture the forward pass in a CUDA graph for repeated inference.
+
+        The model is run on a static input buffer of shape (batch_size,
+        in_channels, input_window_samples), three times to warm up and then
+        once more while capturing all its kernel launches in a CUDA graph.
+        Predicting then only copies the batch into the buffer and replays the
+        graph, which removes the Python and launch overhead of the many small
+        convolutions. The model is set to evaluation mode and must already be
+        on GPU. Its parameters must not be reassigned afterwards, e.g. by
+        :meth:`fuse_for_inference`, which should be called before capturing.
+
+        Parameters
+        ----------
+        batch_size : int
+            Batch size of the inputs the graph is captured for.
+
+        Returns
+        -------
+        predict : callable
+            Function taking a batch of EEG windows of the captured shape and
+            returning the outputs of the model. Inputs of any other shape
+            raise a ValueError.
+        """
+        device = self.fc.weight.device
+        if device.type != "cuda":
+            raise ValueError(
+                "CUDA graphs can only be captured for a model on GPU. Call "
+                "model.cuda() first."
+            )
+        self.eval()
+        static_in = torch.zeros(
+            (batch_size, self.in_channels, self.input_window_samples),
+            device=device)
+        with torch.no_grad():
+            # Warm up on a side stream, as required before capturing
+            stream = torch.cuda.Stream(device)
+            stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self(static_in)
+            torch.cuda.current_stream(device).wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_out = self(static_in)
+
+        def predict(X):
+            _copy_to_static_input(static_in, X)
+            graph.replay()
+            return static_out.clone()
+
+        return predict
+
+    def to_tensorrt(self, precision="fp16", batch_size=1):
+        """Compile the model with TensorRT for inference on NVIDIA GPUs.
+
+        Requires the optional dependency ``torch_tensorrt``, installed with
+        ``pip install braindecode[tensorrt]``. Batch norm layers are first
+        folded into the convolutions (see
+        :meth:`fuse_for_inference`), then the model is scripted and compiled
+        ahead of time by TensorRT, which fuses the remaining convolutions,
+        activations and concatenations and selects the fastest kernels for
+        the fixed input shape (batch_size, in_channels, input_window_samples).
+
+        .. warning::
+            This has not been verified on GPU. The scripted graph contains a
+            branch on ``torch.is_grad_enabled()`` (in the max pooling) and the
+            input shape check, which TensorRT may not lower, in which case
+            these parts fall back to TorchScript.
+
+        Parameters
+        ----------
+        precision : str
+            ``"fp16"`` to let TensorRT run layers in half precision, or
+            ``"fp32"`` to keep single precision.
+        batch_size : int
+            Batch size of the inputs the model is compiled for.
+
+        Returns
+        -------
+        model : torch.jit.ScriptModule
+            The compiled model, expecting float32 inputs on GPU. The model
+            itself is left unchanged.
+        """
+        precisions = {"fp16": torch.float16, "fp32": torch.float32}
+        if precision not in precisions:
+            raise ValueError(
+                f"precision must be one of {list(precisions)}, got "
+                f"{precision!r}."
+            )
+        try:
+            import torch_tensorrt
+        except ModuleNotFoundError as e:
+            raise ModuleNotFoundError(
+                "to_tensorrt requires torch_tensorrt, install it with "
+                "`pip install braindecode[tensorrt]`."
+            ) from e
+
+        model = copy.deepcopy(self).eval().fuse_for_inference().cuda()
+        return torch_tensorrt.compile(
+            torch.jit.script(model),
+            ir="ts",
+            inputs=[torch_tensorrt.Input(
+                (batch_size, self.in_channels, self.input_window_samples),
+                dtype=torch.float32,
+            )],
+            enabled_precisions={precisions[precision]},
+        )
+
+    def fuse_for_inference(self):
+        """Fold batch normalization layers into the preceding convolutions.
+
+        In evaluation mode, batch normalization is a per-channel affine
+        transform which can be absorbed into the weights and bias of the
+        convolution preceding it. This saves a full pass over the activations
+        of each inception and residual module. The model is modified in place
+        and should not be trained afterwards.
+
+        Returns
+        -------
+        self : EEGInceptionMI
+            The fused model.
+        """
+        if self.training:
+            raise ValueError(
+                "Batch normalization layers can only be fused in evaluation "
+                "mode. Call model.eval() first."
+            )
+        for module in self.modules():
+            if isinstance(module, (_InceptionModuleMI, _ResidualModuleMI)):
+                module._fuse_bn()
+        return self
 
 
 class _InceptionModuleMI(nn.Module):
@@ -187,17 +535,14 @@ class _InceptionModuleMI(nn.Module):
         self,
         in_channels,
         n_filters,
-        n_convs,
-        kernel_unit_s=0.1,
-        sfreq=250,
+        kernel_sizes,
         activation=nn.ReLU(),
     ):
         super().__init__()
         self.in_channels = in_channels
         self.n_filters = n_filters
-        self.n_convs = n_convs
-        self.kernel_unit_s = kernel_unit_s
-        self.sfreq = sfreq
+        self.kernel_sizes = list(kernel_sizes)
+        self.n_convs = len(self.kernel_sizes)
 
         self.bottleneck = nn.Conv2d(
             in_channels=self.in_channels,
@@ -206,38 +551,45 @@ class _InceptionModuleMI(nn.Module):
             bias=True,
         )
 
-        kernel_unit = int(self.kernel_unit_s * self.sfreq)
-
         # XXX Maxpooling is usually used to reduce spatial resolution, with a
         # stride equal to the kernel size... But it seems the authors use
         # stride=1 in their paper according to the output shapes from Table3,
         # although this is not clearly specified in the paper text.
-        self.pooling = nn.MaxPool2d(
-            kernel_size=(1, kernel_unit),
-            stride=1,
-            padding=(0, int(kernel_unit // 2)),
-        )
+        # The pooling kernel has the size of the smallest convolution kernel
+        self.pooling = _TemporalMaxPool(kernel_size=self.kernel_sizes[0])
 
+        # Convolutions followed by batch norm have no bias, as it would be
+        # cancelled by the mean subtraction of the batch norm. The bottleneck
+        # keeps its bias, as the zero padding of the branch convolutions
+        # following it makes it contribute differently at the edges.
         self.pooling_conv = nn.Conv2d(
             in_channels=self.in_channels,
             out_channels=self.n_filters,
             kernel_size=1,
-            bias=True,
+            bias=False,
         )
 
-        self.conv_list = nn.ModuleList([
-            nn.Conv2d(
-                in_channels=self.n_filters,
-                out_channels=self.n_filters,
-                kernel_size=(1, (n_units * 2 + 1) * kernel_unit),
-                padding="same",
-                bias=True,
-            ) for n_units in range(self.n_convs)
-        ])
+        # The kernels of all branch convolutions are stored back to back in a
+        # single flat parameter, so that they are contiguous in memory. Each
+        # branch kernel is laid out as (out, 1, k, in), i.e. in channels last
+        # format, like the inputs of the module.
+        self._weight_offsets = [0]
+        for kernel_size in self.kernel_sizes:
+            self._weight_offsets.append(
+                self._weight_offsets[-1]
+                + self.n_filters * self.n_filters * kernel_size)
+        self.packed_weight = nn.Parameter(
+            torch.empty(self._weight_offsets[-1]))
+        # Only set when batch norm is fused into the convolutions
+        self.register_parameter("packed_bias", None)
+        self._reset_packed_parameters()
 
         self.bn = nn.BatchNorm2d(self.n_filters * (self.n_convs + 1))
 
         self.activation = activation
+        # The batch norm output is not used anywhere else, so a ReLU can be
+        # applied in place, saving the allocation of a new activation tensor.
+        self._inplace_relu = isinstance(activation, nn.ReLU)
 
     def forward(
         self,
@@ -245,16 +597,105 @@ class _InceptionModuleMI(nn.Module):
     ) -> torch.Tensor:
         X1 = self.bottleneck(X)
 
-        X1 = [conv(X1) for conv in self.conv_list]
+        # Convolution arguments are all given explicitly, as lists, which is
+        # required by quantized convolutions. For odd kernel sizes, the only
+        # ones for which the pooling branch keeps the number of time samples,
+        # this padding is equivalent to padding="same".
+        branches = [
+            F.conv2d(
+                X1,
+                self._branch_weight(i),
+                self._branch_bias(i),
+                (1, 1),
+                (0, self.kernel_sizes[i] // 2),
+                (1, 1),
+                1,
+            ) for i in range(self.n_convs)
+        ]
 
         X2 = self.pooling(X)
         X2 = self.pooling_conv(X2)
 
-        out = torch.cat(X1 + [X2], 1)
+        # Branch outputs are concatenated. Writing them into channel slices
+        # of a preallocated output instead was measured no faster on CPU.
+        out = torch.cat(branches + [X2], 1)
 
-        out = self.bn(out)
+        if not torch.jit.is_scripting() and _is_autocast_enabled():
+            out = _batch_norm_fp32(self.bn, out)
+        else:
+            out = self.bn(out)
+        if self._inplace_relu:
+            return F.relu(out, inplace=True)
         return self.activation(out)
 
+    def _reset_packed_parameters(self):
+        # Same initialization as the default one of nn.Conv2d
+        for i, kernel_size in enumerate(self.kernel_sizes):
+            bound = 1 / math.sqrt(self.n_filters * kernel_size)
+            nn.init.uniform_(self._branch_weight(i), -bound, bound)
+
+    def _branch_weight(self, i: int) -> torch.Tensor:
+        """Return the (out, in, 1, k) kernel of branch i as a view."""
+        start, stop = self._weight_offsets[i], self._weight_offsets[i + 1]
+        return self.packed_weight[start:stop].view(
+            self.n_filters, 1, self.kernel_sizes[i], self.n_filters,
+        ).permute(0, 3, 1, 2)
+
+    def _branch_bias(self, i: int) -> Optional[torch.Tensor]:
+        bias = self.packed_bias
+        if bias is None:
+            return None
+        return bias[i * self.n_filters:(i + 1) * self.n_filters]
+
+    def _fuse_bn(self):
+        if isinstance(self.bn, nn.Identity):
+            return
+        # self.bn normalizes the concatenation of the outputs of the branch
+        # convolutions and of self.pooling_conv, so each convolution is fused
+        # with its own slice of the batch norm.
+        biases = list()
+        with torch.no_grad():
+            for i in range(self.n_convs):
+                bn = _slice_batch_norm(
+                    self.bn, i * self.n_filters, (i + 1) * self.n_filters)
+                weight, bias = fuse_conv_bn_weights(
+                    self._branch_weight(i), self._branch_bias(i),
+                    bn.running_mean, bn.running_var, bn.eps, bn.weight,
+                    bn.bias,
+                )
+                self._branch_weight(i).copy_(weight)
+                biases.append(bias)
+            self.packed_bias = nn.Parameter(torch.cat(biases))
+        self.pooling_conv = fuse_conv_bn_eval(
+            self.pooling_conv,
+            _slice_batch_norm(
+                self.bn, self.n_convs * self.n_filters,
+                (self.n_convs + 1) * self.n_filters),
+        )
+        self.bn = nn.Identity()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Convert the parameters of the former nn.ModuleList of branch
+        # convolutions to the packed parameters
+        if prefix + "conv_list.0.weight" in state_dict:
+            weights, biases = list(), list()
+            for i in range(self.n_convs):
+                weight = state_dict.pop(f"{prefix}conv_list.{i}.weight")
+                weights.append(weight.permute(0, 2, 3, 1).reshape(-1))
+                biases.append(state_dict.pop(f"{prefix}conv_list.{i}.bias"))
+            state_dict[prefix + "packed_weight"] = torch.cat(weights)
+            state_dict[prefix + "packed_bias"] = torch.cat(biases)
+        # Convert the biases of convolutions followed by batch norm, which
+        # were dropped
+        if self.packed_bias is None:
+            _absorb_bias_in_running_mean(
+                state_dict, prefix + "packed_bias", prefix + "bn.running_mean")
+        if self.pooling_conv.bias is None:
+            _absorb_bias_in_running_mean(
+                state_dict, prefix + "pooling_conv.bias",
+                prefix + "bn.running_mean", start=self.n_convs * self.n_filters)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class _ResidualModuleMI(nn.Module):
     def __init__(
@@ -267,13 +708,15 @@ class _ResidualModuleMI(nn.Module):
         self.in_channels = in_channels
         self.n_filters = n_filters
         self.activation = activation
+        # Same as in _InceptionModuleMI
+        self._inplace_relu = isinstance(activation, nn.ReLU)
 
         self.bn = nn.BatchNorm2d(self.n_filters)
         self.conv = nn.Conv2d(
             in_channels=self.in_channels,
             out_channels=self.n_filters,
             kernel_size=1,
-            bias=True,
+            bias=False,
         )
 
     def forward(
@@ -281,9 +724,144 @@ class _ResidualModuleMI(nn.Module):
         X: torch.Tensor,
     ) -> torch.Tensor:
         out = self.conv(X)
-        out = self.bn(out)
+        if not torch.jit.is_scripting() and _is_autocast_enabled():
+            out = _batch_norm_fp32(self.bn, out)
+        else:
+            out = self.bn(out)
+        if self._inplace_relu:
+            return F.relu(out, inplace=True)
         return self.activation(out)
 
+    def _fuse_bn(self):
+        if isinstance(self.bn, nn.Identity):
+            return
+        self.conv = fuse_conv_bn_eval(self.conv, self.bn)
+        self.bn = nn.Identity()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.conv.bias is None:
+            _absorb_bias_in_running_mean(
+                state_dict, prefix + "conv.bias", prefix + "bn.running_mean")
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class _TemporalMaxPool(nn.Module):
+    """Max pooling over time with stride 1 and "same" padding.
+
+    Equivalent to ``nn.MaxPool2d((1, k), stride=1, padding=(0, k // 2))``.
+    When gradients are not needed, it is computed with O(log k) elementwise
+    maxima over shifted views of the input instead: the maximum over windows
+    of size 2w is the maximum of two windows of size w shifted by w. With
+    channels last inputs, these are vectorized passes over contiguous memory,
+    which run about twice faster than the max pooling kernel for the kernel
+    sizes used here. Their backward is slower though, so max pooling is kept
+    for training.
+    """
+    def __init__(self, kernel_size):
+        super().__init__()
+        self.kernel_size = kernel_size
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        padding = self.kernel_size // 2
+        if torch.is_grad_enabled():
+            return F.max_pool2d(
+                X, (1, self.kernel_size), (1, 1), (0, padding))
+
+        X = F.pad(X, (padding, padding), value=float("-inf"))
+        n_times = X.shape[-1] - self.kernel_size + 1
+        width = 1
+        while 2 * width <= self.kernel_size:
+            X = torch.maximum(X[..., :-width], X[..., width:])
+            width *= 2
+        # X[..., t] is now the max over [t, t + width), with
+        # width <= kernel_size < 2 * width, so two windows cover [t, t + k)
+        offset = self.kernel_size - width
+        return torch.maximum(X[..., :n_times], X[..., offset:offset + n_times])
+
+    def extra_repr(self):
+        return f"kernel_size={self.kernel_size}"
+
+
+def _is_compiling() -> bool:
+    # torch.compiler.is_compiling is not available in older torch versions
+    compiler = getattr(torch, "compiler", None)
+    if compiler is None or not hasattr(compiler, "is_compiling"):
+        return False
+    return compiler.is_compiling()
+
+
+@torch.jit.unused
+def _is_autocast_enabled() -> bool:
+    try:
+        return (torch.is_autocast_enabled("cuda")
+                or torch.is_autocast_enabled("cpu"))
+    except TypeError:
+        # Older torch versions have no device_type argument
+        return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+
+@torch.jit.unused
+def _batch_norm_fp32(bn: nn.Module, X: torch.Tensor) -> torch.Tensor:
+    """Apply batch norm in float32, outside of autocast."""
+    with torch.autocast(device_type=X.device.type, enabled=False):
+        return bn(X.float())
+
+
+def _copy_to_static_input(static_in, X):
+    """Copy X into the static input buffer of a CUDA graph.
+
+    The shapes must match exactly: copy_ would otherwise silently broadcast
+    e.g. a single window to the whole batch.
+    """
+    if X.shape != static_in.shape:
+        raise ValueError(
+            f"Expected inputs of shape {tuple(static_in.shape)}, as captured "
+            f"in the CUDA graph, got {tuple(X.shape)}."
+        )
+    static_in.copy_(X)
+
 
-def _transpose_to_b_c_1_t(x):
-    return x.permute(0, 1, 3, 2)
+def _reshape_input(X: torch.Tensor) -> torch.Tensor:
+    """Reshape inputs to (batch_size, n_channels, 1, n_times).
+
+    This is a free view for both (batch_size, n_channels, n_times) and
+    (batch_size, n_channels, n_times, 1) inputs, on which convolutions are
+    applied. Other shapes raise a ValueError.
+    """
+    if X.ndim != 3 and not (X.ndim == 4 and X.shape[-1] == 1):
+        raise ValueError(
+            "Expected inputs of shape (batch_size, in_channels, n_times) or "
+            "(batch_size, in_channels, n_times, 1), got " + str(X.shape) + "."
+        )
+    return X.reshape(X.shape[0], X.shape[1], 1, -1)
+
+
+# Keep the shape check out of FX graphs, where the input shape is unknown
+torch.fx.wrap("_reshape_input")
+
+
+def _absorb_bias_in_running_mean(state_dict, bias_key, running_mean_key,
+                                 start=0):
+    """Remove a convolution bias from a state dict, absorbing it in the
+    running mean of the batch norm following the convolution.
+
+    In evaluation mode, this gives the same outputs as the convolution with
+    bias. In training mode, the bias is cancelled by the batch norm anyway.
+    """
+    if bias_key not in state_dict or running_mean_key not in state_dict:
+        return
+    bias = state_dict.pop(bias_key)
+    running_mean = state_dict[running_mean_key].clone()
+    running_mean[start:start + len(bias)] -= bias
+    state_dict[running_mean_key] = running_mean
+
+
+def _slice_batch_norm(bn, start, stop):
+    """Return a batch norm layer restricted to channels start:stop of bn."""
+    bn_slice = nn.BatchNorm2d(stop - start, eps=bn.eps, momentum=bn.momentum)
+    with torch.no_grad():
+        bn_slice.weight.copy_(bn.weight[start:stop])
+        bn_slice.bias.copy_(bn.bias[start:stop])
+        bn_slice.running_mean.copy_(bn.running_mean[start:stop])
+        bn_slice.running_var.copy_(bn.running_var[start:stop])
+    return bn_slice.to(bn.running_mean.device).eval()
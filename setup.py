@@ -34,6 +34,10 @@ setup(
     license='BSD 3-Clause',
 
     install_requires=['mne', 'numpy', 'pandas', 'scipy', 'matplotlib', 'h5py', 'skorch'],
+    extras_require={
+        # For EEGInceptionMI.to_tensorrt
+        'tensorrt': ['torch-tensorrt'],
+    },
     # tests_require = [...]
 
     # See https://PyPI.python.org/PyPI?%3Aaction=list_classifiers
@@ -6,6 +6,8 @@
 # License: BSD-3
 
 
+import copy
+
 import numpy as np
 import torch
 import pytest
@@ -14,6 +16,8 @@ from braindecode.models import (
     Deep4Net, EEGNetv4, EEGNetv1, HybridNet, ShallowFBCSPNet, EEGResNet, TCN,
     SleepStagerChambon2018, SleepStagerBlanco2020, SleepStagerEldele2021, USleep,
     DeepSleepNet, EEGITNet, EEGInception, EEGInceptionERP, EEGInceptionMI, TIDNet, ATCNet)
+from braindecode.models.eeginception_mi import (
+    _InceptionModuleMI, _TemporalMaxPool, _copy_to_static_input)
 
 
 from braindecode.util import set_random_seeds
@@ -165,6 +169,20 @@ def test_eeginception_mi(input_sizes):
     check_forward_pass(model, input_sizes,)
 
 
+def test_eeginception_mi_input_shape():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4).eval()
+    X = torch.randn(2, 3, 250)
+    with torch.no_grad():
+        np.testing.assert_allclose(
+            model(X.unsqueeze(-1)).numpy(), model(X).numpy())
+        with pytest.raises(ValueError):
+            model(torch.randn(2, 3, 250, 2))
+        with pytest.raises(ValueError):
+            model(X[0])
+
+
 @pytest.mark.parametrize(
     "n_filter,reported",
     [(6, 51386), (12, 204002), (16, 361986), (24, 812930), (64, 5767170)]
@@ -178,6 +196,11 @@ def test_eeginception_mi_binary_n_params(n_filter, reported):
     For some reason, we match the correct number of parameters for all
     configurations in the binary classification case, but none for the 4-class
     case... Should be investigated by contacting the authors.
+
+    The reported numbers include the biases of convolutions followed by batch
+    norm, which we drop as they are redundant with the batch norm shift. There
+    are (n_convs + 1) * n_filter such biases in each of the 6 inception modules
+    and 2 residual modules.
     """
     model = EEGInceptionMI(
         in_channels=3,
@@ -191,7 +214,296 @@ def test_eeginception_mi_binary_n_params(n_filter, reported):
 
     n_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     # From first column of TABLE 2 in EEG-Inception paper
-    assert n_params == reported
+    assert n_params == reported - 8 * (3 + 1) * n_filter
+
+
+def test_eeginception_mi_fuse_for_inference(input_sizes):
+    sfreq = 250
+    model = EEGInceptionMI(
+        n_classes=input_sizes['n_classes'],
+        in_channels=input_sizes['n_channels'],
+        input_window_s=input_sizes['n_in_times'] / sfreq,
+        sfreq=sfreq,
+        n_filters=8,
+    )
+    rng = np.random.RandomState(42)
+    X = torch.Tensor(rng.randn(
+        input_sizes['n_samples'], input_sizes['n_channels'],
+        input_sizes['n_in_times']).astype(np.float32))
+
+    with pytest.raises(ValueError):
+        model.fuse_for_inference()
+
+    # Populate the running statistics of batch norm layers
+    with torch.no_grad():
+        model(X)
+    model.eval()
+    with torch.no_grad():
+        expected = model(X)
+        model.fuse_for_inference()
+        fused = model(X)
+
+    assert not any(
+        isinstance(module, torch.nn.BatchNorm2d) for module in model.modules())
+    np.testing.assert_allclose(
+        fused.numpy(), expected.numpy(), rtol=1e-4, atol=1e-5)
+
+
+def test_eeginception_mi_simplify_matched_residual(input_sizes):
+    sfreq = 250
+    kwargs = dict(
+        n_classes=input_sizes['n_classes'],
+        in_channels=input_sizes['n_channels'],
+        input_window_s=input_sizes['n_in_times'] / sfreq,
+        sfreq=sfreq,
+        n_filters=8,
+    )
+    model = EEGInceptionMI(simplify_matched_residual=True, **kwargs)
+    check_forward_pass(model, input_sizes)
+
+    n_params = sum(p.numel() for p in model.parameters())
+    n_params_paper = sum(
+        p.numel() for p in EEGInceptionMI(**kwargs).parameters())
+    # 1x1 convolution and batch norm on 6 * 8 channels
+    assert n_params_paper - n_params == 48 * 48 + 2 * 48
+
+
+def test_eeginception_mi_logits(input_sizes):
+    sfreq = 250
+    kwargs = dict(
+        n_classes=input_sizes['n_classes'],
+        in_channels=input_sizes['n_channels'],
+        input_window_s=input_sizes['n_in_times'] / sfreq,
+        sfreq=sfreq,
+        n_filters=8,
+    )
+    set_random_seeds(0, False)
+    model = EEGInceptionMI(**kwargs).eval()
+    set_random_seeds(0, False)
+    model_logits = EEGInceptionMI(add_log_softmax=False, **kwargs).eval()
+
+    X = torch.randn(
+        input_sizes['n_samples'], input_sizes['n_channels'],
+        input_sizes['n_in_times'])
+    with torch.no_grad():
+        log_probas = model(X)
+        logits = model_logits(X)
+    np.testing.assert_allclose(
+        torch.log_softmax(logits, dim=1).numpy(), log_probas.numpy(),
+        rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+def test_eeginception_mi_to_frozen():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4)
+    X = torch.randn(2, 3, 250)
+    frozen = model.to_frozen()
+    assert not model.training
+    with torch.no_grad():
+        np.testing.assert_allclose(
+            frozen(X).numpy(), model(X).numpy(), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("training", [False, True])
+def test_eeginception_mi_cuda_overlapping_residuals(training):
+    set_random_seeds(0, False)
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4, overlap_residual_streams=True).train(training)
+    model_cuda = copy.deepcopy(model).cuda()
+    assert not model._overlap_residuals()
+    assert model_cuda._overlap_residuals()
+    X = torch.randn(4, 3, 250)
+
+    out = model(X)
+    out_cuda = model_cuda(X.cuda())
+    # Convolutions may use TF32 on GPU
+    np.testing.assert_allclose(
+        out_cuda.detach().cpu().numpy(), out.detach().numpy(),
+        rtol=5e-3, atol=5e-3)
+    if training:
+        out.sum().backward()
+        out_cuda.sum().backward()
+        np.testing.assert_allclose(
+            model_cuda.fc.weight.grad.cpu().numpy(),
+            model.fc.weight.grad.numpy(), rtol=5e-3, atol=5e-3)
+
+
+def test_eeginception_mi_overlap_residual_streams_default():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4)
+    # Simulate a model on GPU
+    model._on_cuda = True
+    assert not model._overlap_residuals()
+
+
+def test_eeginception_mi_predict():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4)
+    X = torch.randn(2, 3, 250)
+
+    bn_dtypes = list()
+
+    def record_dtypes(module, inputs, output):
+        bn_dtypes.extend([inputs[0].dtype, output.dtype])
+
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.register_forward_hook(record_dtypes)
+    conv_dtypes = list()
+    model.residual_block_1.conv.register_forward_hook(
+        lambda module, inputs, output: conv_dtypes.append(output.dtype))
+
+    y_pred = model.predict(X)
+    assert not model.training
+    assert y_pred.dtype == torch.float32
+    # Batch norm layers run in float32, convolutions in bfloat16
+    assert len(bn_dtypes) == 2 * 8
+    assert set(bn_dtypes) == {torch.float32}
+    assert conv_dtypes == [torch.bfloat16]
+    with torch.no_grad():
+        np.testing.assert_allclose(
+            y_pred.numpy(), model(X).numpy(), rtol=0.05, atol=0.05)
+
+
+def test_eeginception_mi_capture_graph_cpu():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4)
+    with pytest.raises(ValueError):
+        model.capture_graph(batch_size=2)
+
+    # Inputs broadcastable to the static input are rejected too
+    static_in = torch.zeros(2, 3, 250)
+    for X in [torch.randn(1, 3, 250), torch.randn(3, 250),
+              torch.randn(4, 3, 250)]:
+        with pytest.raises(ValueError):
+            _copy_to_static_input(static_in, X)
+    X = torch.randn(2, 3, 250)
+    _copy_to_static_input(static_in, X)
+    assert torch.equal(static_in, X)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("fused", [False, True])
+def test_eeginception_mi_capture_graph(fused):
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4).cuda()
+    X = torch.randn(2, 3, 250, device="cuda")
+    with torch.no_grad():
+        model(X)
+    if fused:
+        model.eval().fuse_for_inference()
+    predict = model.capture_graph(batch_size=2)
+    assert not model.training
+    with torch.no_grad():
+        for _ in range(2):
+            X = torch.randn(2, 3, 250, device="cuda")
+            np.testing.assert_allclose(
+                predict(X).cpu().numpy(), model(X).cpu().numpy(),
+                rtol=1e-5, atol=1e-5)
+        with pytest.raises(ValueError):
+            predict(X[:1])
+
+
+def test_eeginception_mi_to_tensorrt_precision():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4)
+    with pytest.raises(ValueError):
+        model.to_tensorrt(precision="int8")
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("precision,tol", [("fp32", 1e-3), ("fp16", 5e-2)])
+def test_eeginception_mi_to_tensorrt(precision, tol):
+    pytest.importorskip("torch_tensorrt")
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4).cuda()
+    X = torch.randn(2, 3, 250, device="cuda")
+    with torch.no_grad():
+        model(X)
+    trt_model = model.to_tensorrt(precision=precision, batch_size=2)
+    assert model.training
+    model.eval()
+    with torch.no_grad():
+        np.testing.assert_allclose(
+            trt_model(X).float().cpu().numpy(), model(X).cpu().numpy(),
+            rtol=tol, atol=tol)
+
+
+def test_eeginception_mi_quantize():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4)
+    X = torch.randn(8, 3, 250)
+    with torch.no_grad():
+        model(X)
+    model.eval()
+    quantized = model.quantize(X)
+    with torch.no_grad():
+        expected = model(X)
+        y_pred = quantized(X)
+    assert y_pred.shape == expected.shape
+    np.testing.assert_allclose(
+        y_pred.numpy(), expected.numpy(), rtol=0.05, atol=0.05)
+
+    with pytest.raises(ValueError):
+        model.quantize([])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+def test_eeginception_mi_quantize_cuda():
+    model = EEGInceptionMI(
+        in_channels=3, n_classes=2, input_window_s=1., n_convs=2,
+        n_filters=4).cuda().eval()
+    X = torch.randn(8, 3, 250, device="cuda")
+    quantized = model.quantize([X[:4], X[4:]])
+    with torch.no_grad():
+        assert quantized(X.cpu()).shape == (8, 2)
+
+
+@pytest.mark.parametrize("kernel_size", [1, 2, 7, 12, 25])
+def test_eeginception_mi_temporal_max_pool(kernel_size):
+    X = torch.randn(2, 5, 1, 100).contiguous(
+        memory_format=torch.channels_last)
+    expected = torch.nn.MaxPool2d(
+        (1, kernel_size), stride=1, padding=(0, kernel_size // 2))(X)
+    pooling = _TemporalMaxPool(kernel_size)
+    with torch.no_grad():
+        pooled = pooling(X)
+    assert torch.equal(pooled, expected)
+    # Max pooling is used when gradients are needed
+    assert torch.equal(pooling(X), expected)
+
+
+def test_eeginception_mi_load_conv_list_state_dict():
+    module = _InceptionModuleMI(
+        in_channels=4, n_filters=3, kernel_sizes=[25, 75, 125])
+    module.bn.running_mean.normal_()
+    state_dict = module.state_dict()
+    del state_dict["packed_weight"]
+    biases = torch.randn(module.n_convs + 1, module.n_filters)
+    for i in range(module.n_convs):
+        state_dict[f"conv_list.{i}.weight"] = module._branch_weight(i).detach()
+        state_dict[f"conv_list.{i}.bias"] = biases[i]
+    state_dict["pooling_conv.bias"] = biases[-1]
+
+    new_module = _InceptionModuleMI(
+        in_channels=4, n_filters=3, kernel_sizes=[25, 75, 125])
+    new_module.load_state_dict(state_dict)
+    assert torch.equal(new_module.packed_weight, module.packed_weight)
+    # Biases of convolutions followed by batch norm are absorbed in it
+    torch.testing.assert_close(
+        new_module.bn.running_mean,
+        module.bn.running_mean - biases.flatten())
 
 
 def test_atcnet(input_sizes):